@@ -1,50 +1,82 @@
 """
-Dirty wrapping of the Mrtrix3 command necessary but not available in Nipype
+Wrapping of the Mrtrix3 commands necessary but not available in Nipype
 
-Quick and dirty wrappings using python function and  nipype's Function interface of
-Mrtrix3 commands
+The commands are wrapped as regular Nipype CommandLine interfaces
+(MRTrix3Base subclasses) so that they participate in the input hashing and
+scheduling machinery of the execution engine
 """
-# TO DO: implement clean wrappings by forking nipype
+
+import os.path as op
 
 import nipype.pipeline.engine as pe
-from nipype.interfaces.utility import Function
+from nipype.interfaces.base import File, TraitedSpec
+from nipype.interfaces.mrtrix3.base import MRTrix3Base, MRTrix3BaseInputSpec
+
+
+class TckSiftInputSpec(MRTrix3BaseInputSpec):
+    input_tracks = File(
+        exists=True,
+        argstr="%s",
+        position=-3,
+        mandatory=True,
+        desc="path of the tractogram to filter",
+    )
+    wm_fod = File(
+        exists=True,
+        argstr="%s",
+        position=-2,
+        mandatory=True,
+        desc="path of the white matter fiber orientation distribution volume",
+    )
+    filtered_tracks = File(
+        "filtered.tck",
+        argstr="%s",
+        position=-1,
+        usedefault=True,
+        desc="path of the filtered tractogram",
+    )
+    act = File(
+        exists=True,
+        argstr="-act %s",
+        desc="tissue classification file used to derive the processing mask",
+    )
+
 
+class TckSiftOutputSpec(TraitedSpec):
+    filtered_tracks = File(exists=True, desc="path of the filtered tractogram")
 
-def tcksift(input_tracks, wm_fod, act, filtered_tracks):
+
+class TckSift(MRTrix3Base):
     """Wrapping of the tcksift command
 
-    Default options and stopping criteria with processing mask derived from act tissue file
-    :param input_tracks: path of the tractogram to filter
-    :param wm_fod: path of the white matter fiber orientation distribution volume
-    used to filter the tractogram
-    :param filtered_tracks: path of the filtered tractogram
-    :return:
+    Default options and stopping criteria with processing mask derived from
+    act tissue file
     """
-    import subprocess
-    from distutils import spawn
 
-    sift = spawn.find_executable("tcksift")
-    print(sift)
-    cmd = [sift, "-act", act, input_tracks, wm_fod, filtered_tracks]
-    subprocess.run(cmd)
-    pass
+    _cmd = "tcksift"
+    input_spec = TckSiftInputSpec
+    output_spec = TckSiftOutputSpec
 
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs["filtered_tracks"] = op.abspath(self.inputs.filtered_tracks)
+        return outputs
 
-def create_sift_filtering_node():
+
+def create_sift_filtering_node(nthreads=None):
     """
 
+    :param nthreads: number of threads used by the Mrtrix3 command (default:
+    hardware maximum)
     :return:
     """
-    sift_filtering = pe.Node(
-        name="sift_filtering",
-        interface=Function(
-            input_names=["input_tracks", "wm_fod", "act", "filtered_tracks"],
-            output_names=["filtered_tracks"],
-            function=tcksift,
-        ),
-    )
+    # mem_gb: conservative estimate for the MultiProc memory budget: tcksift
+    # holds the whole tractogram in RAM (several GB per million streamlines)
+    sift_filtering = pe.Node(interface=TckSift(), name="sift_filtering",
+                             mem_gb=24)
     sift_filtering.inputs.filtered_tracks = 'filtered.tck'
+    if nthreads is not None:
+        sift_filtering.inputs.nthreads = nthreads
+        # let resource-aware plugins (MultiProc) account for the thread pool
+        sift_filtering.n_procs = nthreads
     return sift_filtering
-
-
-
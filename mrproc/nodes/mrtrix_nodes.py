@@ -6,27 +6,43 @@ import nipype.pipeline.engine as pe
 from nipype.interfaces import mrtrix3
 
 
-def create_tissue_classification_node():
+def create_tissue_classification_node(nthreads=None):
     """
     Instanciate T1 volume tissue classification Nipype node
+    :param nthreads: number of threads used by the Mrtrix3 command (default:
+    hardware maximum)
     :return: tissue_classif (Nipype Node)
     """
     # Tissue classification from T1 MRI data
     tissue_classif = pe.Node(interface=mrtrix3.Generate5tt(), name="tissue_classif")
     # rely on FSL for T1 tissue segmentation
     tissue_classif.inputs.algorithm = "fsl"
-    tissue_classif.inputs.out_file = '5tt.nii.gz'
+    # uncompressed .mif: the file is only read back by Mrtrix3 commands and
+    # skipping gzip spares one compression/decompression pass per consumer
+    tissue_classif.inputs.out_file = '5tt.mif'
+    if nthreads is not None:
+        tissue_classif.inputs.nthreads = nthreads
+        # let resource-aware plugins (MultiProc) account for the thread pool
+        tissue_classif.n_procs = nthreads
     return tissue_classif
 
 
-def create_tractography_node():
+def create_tractography_node(nthreads=None):
     """
     Generate whole brain probabilistic tractogram Nipype node
+    :param nthreads: number of threads used by the Mrtrix3 command (default:
+    hardware maximum)
     :return:
     """
+    # mem_gb: conservative estimate for the MultiProc memory budget (FOD and
+    # 5tt volumes plus the streamline write buffers)
     tractography = pe.Node(interface=mrtrix3.tracking.Tractography(),
-                           name="tractography")
+                           name="tractography", mem_gb=8)
     tractography.inputs.algorithm = "iFOD2"
     tractography.inputs.crop_at_gmwmi = True
     tractography.inputs.backtrack = True
+    if nthreads is not None:
+        tractography.inputs.nthreads = nthreads
+        # let resource-aware plugins (MultiProc) account for the thread pool
+        tractography.n_procs = nthreads
     return tractography
@@ -14,6 +14,7 @@ Pipelines rely on MRtrix3, FSL, Ants and Nipype package
 """
 
 import nipype.pipeline.engine as pe
+from nipype.interfaces import io
 from nipype.interfaces import utility
 from nipype.interfaces import mrtrix3
 from nipype.interfaces import fsl
@@ -25,24 +26,43 @@ from mrproc.nodes.custom_nodes import create_sift_filtering_node
 
 
 
-def create_preprocessing_pipeline():
+def create_preprocessing_pipeline(nthreads=None):
     """
     Bias correction and gross masking of a distortion corrected diffusion weighted volume
+    :param nthreads: number of threads used by the Mrtrix3 commands (default:
+    hardware maximum)
     :return:
     """
 
     # Nodes in
     inputnode = pe.Node(
-        utility.IdentityInterface(fields=["diffusion_volume"], mandatory_inputs=False),
+        utility.IdentityInterface(
+            fields=["diffusion_volume", "bvals", "bvecs"], mandatory_inputs=False
+        ),
         name="inputnode",
     )
+    # identity nodes are trivial pass-throughs: running them in the master
+    # process skips a worker submission and interpreter start-up per hop
+    inputnode.run_without_submitting = True
     # Bias correction of the diffusion MRI data (for more quantitative approach)
+    # mem_gb: conservative estimate for the MultiProc memory budget (ANTs N4
+    # loads the full diffusion series)
     diffusionbiascorrect = pe.Node(
         interface=mrtrix3.preprocess.DWIBiasCorrect(use_ants=True),
-        name="diffusionbiascorrect"
+        name="diffusionbiascorrect",
+        mem_gb=8,
     )
+    # .mif output embeds the gradient table so downstream Mrtrix3 commands
+    # (masking, tensor, CSD) read it from the header
+    diffusionbiascorrect.inputs.out_file = 'biascorr.mif'
     # Gross brain mask stemming from diffusion data
     diffusion2mask = pe.Node(interface=mrtrix3.utils.BrainMask(), name="diffusion2mask")
+    if nthreads is not None:
+        diffusionbiascorrect.inputs.nthreads = nthreads
+        diffusion2mask.inputs.nthreads = nthreads
+        # let resource-aware plugins (MultiProc) account for the thread pools
+        diffusionbiascorrect.n_procs = nthreads
+        diffusion2mask.n_procs = nthreads
     # Output Node
     outputnode = pe.Node(
         utility.IdentityInterface(
@@ -50,10 +70,13 @@ def create_preprocessing_pipeline():
         ),
         name="outputnode",
     )
+    outputnode.run_without_submitting = True
 
     # Workflow connections
     preproc = pe.Workflow(name="preprocessing")
     preproc.connect(inputnode, "diffusion_volume", diffusionbiascorrect, "in_file")
+    preproc.connect(inputnode, "bvals", diffusionbiascorrect, "in_bval")
+    preproc.connect(inputnode, "bvecs", diffusionbiascorrect, "in_bvec")
     preproc.connect(diffusionbiascorrect, "out_file", diffusion2mask, "in_file")
     preproc.connect(
         diffusionbiascorrect, "out_file", outputnode, "corrected_diffusion_volume"
@@ -63,9 +86,11 @@ def create_preprocessing_pipeline():
     return preproc
 
 
-def create_tensor_pipeline():
+def create_tensor_pipeline(nthreads=None):
     """
     Estimate diffusion tensor coefficients and compute FA
+    :param nthreads: number of threads used by the Mrtrix3 commands (default:
+    hardware maximum)
     :return:
     """
     # Nodes
@@ -75,6 +100,7 @@ def create_tensor_pipeline():
         ),
         name="inputnode",
     )
+    inputnode.run_without_submitting = True
     # tensor coefficients estimation
     diffusion2tensor = pe.Node(
         interface=mrtrix3.reconst.FitTensor(), name="diffusion2tensor"
@@ -82,12 +108,18 @@ def create_tensor_pipeline():
     # derived FA contrast (force nifti format to do registration with FSL or Ants)
     tensor2fa = pe.Node(interface=mrtrix3.TensorMetrics(out_fa='fa.nii.gz'),
                         name="tensor2fa")
+    if nthreads is not None:
+        diffusion2tensor.inputs.nthreads = nthreads
+        tensor2fa.inputs.nthreads = nthreads
+        diffusion2tensor.n_procs = nthreads
+        tensor2fa.n_procs = nthreads
     outputnode = pe.Node(
         utility.IdentityInterface(
             fields=["tensor_coeff", "fa"], mandatory_inputs=False
         ),
         name="outputnode",
     )
+    outputnode.run_without_submitting = True
 
     # Workflow structure
     tensor = pe.Workflow(name="tensor")
@@ -100,10 +132,12 @@ def create_tensor_pipeline():
     return tensor
 
 
-def create_spherical_deconvolution_pipeline():
+def create_spherical_deconvolution_pipeline(nthreads=None):
     """
     Estimate impulsional response and derived multi-shell multi tissue fiber
     orientation distribution (FOD)
+    :param nthreads: number of threads used by the Mrtrix3 commands (default:
+    hardware maximum)
     :return:
     """
 
@@ -114,6 +148,7 @@ def create_spherical_deconvolution_pipeline():
         ),
         name="inputnode",
     )
+    inputnode.run_without_submitting = True
     diffusion2response = pe.Node(
         interface=mrtrix3.preprocess.ResponseSD(), name="diffusion2response"
     )
@@ -122,17 +157,26 @@ def create_spherical_deconvolution_pipeline():
     diffusion2response.inputs.algorithm = "msmt_5tt"
 
     # Multi-shell multi tissue spherical deconvolution of the diffusion MRI data
+    # mem_gb: conservative estimate for the MultiProc memory budget (diffusion
+    # series plus the three ODF volumes)
     diffusion2fod = pe.Node(
         interface=mrtrix3.reconst.ConstrainedSphericalDeconvolution(),
         name="diffusion2fod",
+        mem_gb=8,
     )
     diffusion2fod.inputs.algorithm = 'msmt_csd'
     diffusion2fod.inputs.csf_odf = 'csf.mif'
     diffusion2fod.inputs.gm_odf = 'gm.mif'
+    if nthreads is not None:
+        diffusion2response.inputs.nthreads = nthreads
+        diffusion2fod.inputs.nthreads = nthreads
+        diffusion2response.n_procs = nthreads
+        diffusion2fod.n_procs = nthreads
     outputnode = pe.Node(
         utility.IdentityInterface(fields=["wm_fod"], mandatory_inputs=False),
         name="outputnode",
     )
+    outputnode.run_without_submitting = True
 
     # Workflow structure
     csd = pe.Workflow(name="msmt_csd")
@@ -164,10 +208,12 @@ def create_spherical_deconvolution_pipeline():
     return csd
 
 
-def create_tractogram_generation_pipeline():
+def create_tractogram_generation_pipeline(nthreads=None):
     """
     Whole brain probabilistic anatomically constrained tractogram generation and 
     sift filtering
+    :param nthreads: number of threads used by the Mrtrix3 commands (default:
+    hardware maximum)
     :return:
     """
 
@@ -180,12 +226,14 @@ def create_tractogram_generation_pipeline():
         ),
         name="inputnode",
     )
-    tractography = create_tractography_node()
-    sift_filtering = create_sift_filtering_node()
+    inputnode.run_without_submitting = True
+    tractography = create_tractography_node(nthreads=nthreads)
+    sift_filtering = create_sift_filtering_node(nthreads=nthreads)
     outputnode = pe.Node(
         utility.IdentityInterface(fields=["tractogram"], mandatory_inputs=False),
         name="outputnode",
     )
+    outputnode.run_without_submitting = True
 
     # Workflow connections
     tractogram_pipeline = pe.Workflow(name="tractogram_pipeline")
@@ -222,29 +270,35 @@ def create_tractogram_generation_pipeline():
     return tractogram_pipeline
 
 
-def create_core_dwi_processing_pipeline():
+def create_core_dwi_processing_pipeline(nthreads=None,
+                                        name="core_dwi_processing_pipeline"):
     """
 
+    :param nthreads: number of threads used by the Mrtrix3 commands (default:
+    hardware maximum)
+    :param name: name of the workflow, which prefixes the working directory
+    of every node
     :return:
     """
     # Pipeline Nodes
     # Inputs params
     inputnode = pe.Node(
         utility.IdentityInterface(
-            fields=["diffusion_volume", "t1_volume", "nb_tracks", "min_length",
-                    "max_length"],
+            fields=["diffusion_volume", "bvals", "bvecs", "t1_volume", "nb_tracks",
+                    "min_length", "max_length"],
             mandatory_inputs=False
         ),
         name="inputnode",
     )
+    inputnode.run_without_submitting = True
     # Processing steps
-    preprocessing = create_preprocessing_pipeline()
+    preprocessing = create_preprocessing_pipeline(nthreads=nthreads)
     # tensor and derived metrics (FA)
-    tensor = create_tensor_pipeline()
+    tensor = create_tensor_pipeline(nthreads=nthreads)
     # t1 brain extraction
     bet = pe.Node(fsl.preprocess.BET(robust=True), name="bet")
     # tissue classification (T1 volume)
-    tissue_classif = create_tissue_classification_node()
+    tissue_classif = create_tissue_classification_node(nthreads=nthreads)
     # rigid registration between diffusion and structural space
     rigid_registration = create_rigid_registration_node()
     # fa (dwi space) upsampling to 1mm to ease rigid registration
@@ -255,9 +309,9 @@ def create_core_dwi_processing_pipeline():
     # inverse rigid transformation
     invxfm = pe.Node(fsl.utils.ConvertXFM(invert_xfm=True), name="invxfm")
     # Multi shell multi tissue spherical deconvolution
-    csd = create_spherical_deconvolution_pipeline()
+    csd = create_spherical_deconvolution_pipeline(nthreads=nthreads)
     # Whole brain anatomically constrained probabilistic tractogram
-    tractogram_pipeline = create_tractogram_generation_pipeline()
+    tractogram_pipeline = create_tractogram_generation_pipeline(nthreads=nthreads)
     # Outputs params
     outputnode = pe.Node(
         utility.IdentityInterface(
@@ -267,11 +321,14 @@ def create_core_dwi_processing_pipeline():
         ),
         name="outputnode",
     )
+    outputnode.run_without_submitting = True
     # mandatory steps of the diffusion pipeline (for the sake of modularity)
-    core_pipeline = pe.Workflow(name="core_dwi_processing_pipeline")
+    core_pipeline = pe.Workflow(name=name)
     core_pipeline.connect(
         inputnode, "diffusion_volume", preprocessing, "inputnode.diffusion_volume"
     )
+    core_pipeline.connect(inputnode, "bvals", preprocessing, "inputnode.bvals")
+    core_pipeline.connect(inputnode, "bvecs", preprocessing, "inputnode.bvecs")
     core_pipeline.connect(
         preprocessing,
         "outputnode.corrected_diffusion_volume",
@@ -331,78 +388,112 @@ def create_core_dwi_processing_pipeline():
     return core_pipeline
 
 
-def create_dwi_processing_pipeline():
-    # Nodes
-    inputnode = pe.Node(
-        utility.IdentityInterface(
-            fields=["diffusion_volume", "bvals", "bvecs", "t1_volume", "nb_tracks",
-                    "min_length", "max_length"],
-            mandatory_inputs=False,
-        ),
-        name="inputnode",
-    )
-    # Data conversion from .nii to .mif file (allows to embed diffusion bvals et bvecs)
-    mrconvert = pe.Node(interface=mrtrix3.MRConvert(), name="mrconvert")
-    # Main processing steps
-    core_pipeline = create_core_dwi_processing_pipeline()
-    # Outputs params
-    outputnode = pe.Node(
-        utility.IdentityInterface(
-            fields=["corrected_diffusion_volume", "wm_fod", "tractogram",
-                    "diffusion_to_t1_transform"],
-            mandatory_inputs=False,
-        ),
-        name="outputnode",
-    )
-
-    dwi_processing_pipeline = pe.Workflow(name="dwi_processing_pipeline")
-    dwi_processing_pipeline.connect(
-        [
-            (
-                inputnode,
-                mrconvert,
-                [
-                    ("diffusion_volume", "in_file"),
-                    ("bvals", "in_bval"),
-                    ("bvecs", "in_bvec"),
-                ],
-            )
-        ]
-    )
-    dwi_processing_pipeline.connect(
-        [
-            (
-                inputnode,
-                core_pipeline,
-                [
-                    ("t1_volume", "inputnode.t1_volume"),
-                    ("nb_tracks", "inputnode.nb_tracks"),
-                    ("min_length", "inputnode.min_length"),
-                    ("max_length", "inputnode.max_length"),
-                ],
-            )
-        ]
-    )
-    dwi_processing_pipeline.connect(
-        mrconvert, "out_file", core_pipeline, "inputnode.diffusion_volume"
-    )
-    dwi_processing_pipeline.connect(
-        core_pipeline,
-        "outputnode.corrected_diffusion_volume",
-        outputnode,
-        "corrected_diffusion_volume",
-    )
-    dwi_processing_pipeline.connect(core_pipeline, "outputnode.wm_fod", outputnode, "wm_fod")
-    dwi_processing_pipeline.connect(
-        core_pipeline, "outputnode.tractogram", outputnode, "tractogram"
-    )
-    dwi_processing_pipeline.connect(
-        core_pipeline, "outputnode.diffusion_to_t1_transform", outputnode,
-        "diffusion_to_t1_transform"
-    )
+def create_dwi_processing_pipeline(nthreads=None, base_dir=None,
+                                   sink_dir=None):
+    """
+    Full diffusion processing pipeline
+    :param nthreads: number of threads used by the Mrtrix3 commands (default:
+    hardware maximum)
+    :param base_dir: working directory holding all the intermediate files of
+    the pipeline. Point it to node-local scratch (e.g. /dev/shm or $TMPDIR)
+    when the final outputs live on a networked filesystem: the heavy Mrtrix3
+    intermediates (tractograms, FOD volumes) are then written locally instead
+    of being pushed over NFS at every node execution
+    :param sink_dir: directory receiving the final outputs (filtered
+    tractogram, wm FOD, corrected diffusion volume). The copy runs in a
+    dedicated DataSink node, so with a parallel plugin it overlaps with the
+    computation of the remaining branches instead of blocking them
+    :return:
+    """
+    # since the conversion step was folded into preprocessing, the core
+    # pipeline is the whole processing graph: expose it directly instead of
+    # nesting it behind an extra pair of identity nodes
+    dwi_processing_pipeline = create_core_dwi_processing_pipeline(
+        nthreads=nthreads, name="dwi_processing_pipeline"
+    )
+    dwi_processing_pipeline.base_dir = base_dir
+    if sink_dir is not None:
+        datasink = pe.Node(io.DataSink(base_directory=sink_dir),
+                           name="datasink")
+        outputnode = dwi_processing_pipeline.get_node("outputnode")
+        dwi_processing_pipeline.connect(
+            outputnode, "tractogram", datasink, "tractogram"
+        )
+        dwi_processing_pipeline.connect(outputnode, "wm_fod", datasink, "wm_fod")
+        dwi_processing_pipeline.connect(
+            outputnode,
+            "corrected_diffusion_volume",
+            datasink,
+            "corrected_diffusion_volume",
+        )
 
     return dwi_processing_pipeline
 
 
+def create_cohort_dwi_processing_pipeline(diffusion_volumes, bvals, bvecs,
+                                          t1_volumes, nthreads=None,
+                                          base_dir=None, sink_dir=None):
+    """
+    Multi-subject variant of the diffusion processing pipeline
+
+    The subject-wise inputs are set as synchronized iterables on the input
+    node, so the whole cohort expands into a single execution graph whose
+    independent subject branches are parallelized by the execution plugin
+    instead of being processed in a Python for loop
+    :param diffusion_volumes: list of diffusion volume paths, one per subject
+    :param bvals: list of bvals file paths, one per subject
+    :param bvecs: list of bvecs file paths, one per subject
+    :param t1_volumes: list of T1 volume paths, one per subject
+    :param nthreads: number of threads used by the Mrtrix3 commands (default:
+    hardware maximum)
+    :param base_dir: working directory holding all the intermediate files of
+    the pipeline
+    :param sink_dir: directory receiving the final outputs of every subject
+    :return:
+    """
+    pipeline = create_dwi_processing_pipeline(nthreads=nthreads,
+                                              base_dir=base_dir,
+                                              sink_dir=sink_dir)
+    inputnode = pipeline.get_node("inputnode")
+    inputnode.iterables = [
+        ("diffusion_volume", diffusion_volumes),
+        ("bvals", bvals),
+        ("bvecs", bvecs),
+        ("t1_volume", t1_volumes),
+    ]
+    # iterate subject-wise, not over the cartesian product of the lists
+    inputnode.synchronize = True
+    return pipeline
+
+
+def run_dwi_processing_pipeline(pipeline, n_procs=None, memory_gb=None,
+                                plugin="MultiProc", plugin_args=None):
+    """
+    Execute a diffusion pipeline with the resource-aware MultiProc plugin
+
+    Independent nodes (e.g. the T1 and diffusion branches) run concurrently
+    while the per-node n_procs declarations keep the Mrtrix3 thread pools
+    from oversubscribing the machine. For cohort sweeps exceeding a single
+    machine, pass one of nipype's cluster plugins instead (e.g.
+    plugin='SLURMGraph' or 'SGEGraph' with the matching plugin_args): the
+    execution graph is then distributed across nodes, one job per node of
+    the expanded workflow
+    :param pipeline: Nipype workflow to execute
+    :param n_procs: maximum number of concurrently used cores (default:
+    all available cores), only meaningful with the MultiProc plugin
+    :param memory_gb: memory budget of the execution (default: 90% of the
+    available RAM), only meaningful with the MultiProc plugin
+    :param plugin: name of the nipype execution plugin (default: MultiProc)
+    :param plugin_args: extra arguments forwarded to the execution plugin
+    :return: execution graph of the pipeline run
+    """
+    plugin_args = dict(plugin_args) if plugin_args else {}
+    if n_procs is not None:
+        plugin_args["n_procs"] = n_procs
+    if memory_gb is not None:
+        plugin_args["memory_gb"] = memory_gb
+    return pipeline.run(plugin=plugin, plugin_args=plugin_args)
+
+
 if __name__ == "__main__":
     pass
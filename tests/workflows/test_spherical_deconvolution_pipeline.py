@@ -0,0 +1,18 @@
+"""
+"""
+
+
+from mrproc.workflows.dwi_processing import create_spherical_deconvolution_pipeline
+
+
+def test_create_spherical_deconvolution_pipeline():
+
+    csd = create_spherical_deconvolution_pipeline()
+    # an invalid connection would have raised at construction time
+    outputnode = csd.get_node('outputnode')
+    assert 'wm_fod' in outputnode.inputs.trait_names()
+
+
+if __name__ == "__main__":
+
+    test_create_spherical_deconvolution_pipeline()